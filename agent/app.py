@@ -1,27 +1,89 @@
 from fastapi import FastAPI
 from pydantic import BaseModel
 from typing import Optional
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import os
+import random
+import re
+from functools import lru_cache
 
 import uvicorn
-from new_agent import generate_plan_from_doc_url, PlanV1
-from google_tools import fetch_google_url_private
-from fastapi.middleware.cors import CORSMiddleware
+from new_agent import aclose_llm_client, build_doc_index, call_llm_chat_streaming_async, PlanV1
+from google_tools import aclose_http_clients, creds_refresh_delay, fetch_google_url_private_async, refresh_creds
 
+logger = logging.getLogger(__name__)
 
+async def _refresh_creds_loop():
+    """
+    Renew the Google token shortly before it expires so no request pays for it.
+    Every worker process runs one of these; the random stagger lets the first
+    worker refresh and save token.json, and the others adopt its token.
+    """
+    while True:
+        try:
+            delay = await asyncio.to_thread(creds_refresh_delay)
+            await asyncio.sleep(delay + random.uniform(0, 30))
+            await asyncio.to_thread(refresh_creds)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Google token refresh failed, retrying in 60s: %s", e)
+            await asyncio.sleep(60)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    task = asyncio.create_task(_refresh_creds_loop())
+    yield
+    task.cancel()
+    await aclose_http_clients()
+    await aclose_llm_client()
 
 app = FastAPI(
     title="Contract Assistant Agent API",
     description="Generates PlanV1 patches for a Google Doc",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # or restrict to your script origin
-    allow_credentials=True,
-    allow_methods=["*"],  # ["POST"] if you want to be strict
-    allow_headers=["*"],
-)
+# ---- CORS ----
+# The sidebar calls us with a plain (non-credentialed) fetch, so fixed allow-all
+# headers are enough; no need for Starlette's per-request origin/method checks.
+_CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+_PREFLIGHT_HEADERS = _CORS_HEADERS + [
+    (b"access-control-allow-methods", b"*"),  # or b"POST" if you want to be strict
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-max-age", b"600"),
+]
+
+class StaticCORSMiddleware:
+    """Answer every OPTIONS with a static 204 preflight; append CORS headers to other responses."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 204, "headers": _PREFLIGHT_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *_CORS_HEADERS]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(StaticCORSMiddleware)
+
+# Precompiled once; _extract_controls_block runs on every request
+_HEADING_RE = re.compile(r"(?m)^##\s")
+_BOM = "\ufeff"
 
 # ---- Request schema ----
 class GeneratePlanRequest(BaseModel):
@@ -30,14 +92,7 @@ class GeneratePlanRequest(BaseModel):
     plan_id: str = "plan_generated_001"
     stream: bool = True  # keep streaming flag so we can disable if needed
 
-# ---- Response schema ----
-class GeneratePlanResponse(PlanV1):
-    pass
-
-import re
-
-import re
-
+@lru_cache(maxsize=16)  # keyed by doc content; the same doc is often re-planned
 def _extract_controls_block(doc_text: str) -> str:
     """
     Extract the first section's body text from a markdown-like doc.
@@ -48,38 +103,37 @@ def _extract_controls_block(doc_text: str) -> str:
         return ""
 
     # Normalize line endings and strip BOM if present
-    text = doc_text.replace("\r\n", "\n").replace("\r", "\n").lstrip("\ufeff").strip("\n")
+    text = doc_text.replace("\r\n", "\n").replace("\r", "\n").lstrip(_BOM).strip("\n")
 
-    # Find all top-level markdown headings starting with '## '
-    heads = [m.start() for m in re.finditer(r"(?m)^##\s", text)]
-    if not heads:
+    # Only the first two top-level '## ' headings matter
+    it = _HEADING_RE.finditer(text)
+    first = next(it, None)
+    if first is None:
         return ""  # No headings found
 
-    first = heads[0]
     # End-of-line for the heading
-    eol = text.find("\n", first)
+    eol = text.find("\n", first.start())
     if eol == -1:
         return ""  # Heading but no body
 
-    # Find next heading if any
-    next_heads = [pos for pos in heads if pos > first]
-    end = next_heads[0] if len(next_heads) > 1 else len(text)
+    # Block runs until the next heading, if any
+    nxt = next(it, None)
+    end = nxt.start() if nxt else len(text)
 
-    # Extract and clean the block
-    body = text[eol+1:end]
-    return body.strip("\n")
+    return text[eol+1:end].strip("\n")
 
 # ---- Endpoint ----
-@app.post("/plan/generate", response_model=GeneratePlanResponse)
-def generate_plan(req: GeneratePlanRequest):
+@app.post("/plan/generate", response_model=PlanV1)
+async def generate_plan(req: GeneratePlanRequest):
     """
     Given a Google Doc URL, read the control block from the doc
     and generate a structured PlanV1 with patches.
     """
     # Step 1: Fetch doc content as plain text
-    fetched = fetch_google_url_private(req.doc_url)
+    fetched = await fetch_google_url_private_async(req.doc_url)
     doc_text = fetched.get("content", "")
-    print(doc_text[:800])
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("fetched doc (%d chars):\n%s", len(doc_text), doc_text[:800])
 
     # Step 2: Extract the "## Control" block until next heading
     controls_text = _extract_controls_block(doc_text)
@@ -87,16 +141,18 @@ def generate_plan(req: GeneratePlanRequest):
     if not controls_text.strip():
         raise ValueError("Could not find '## Control' block in document.")
 
-    # Step 3: Call your existing plan generator
-    plan = generate_plan_from_doc_url(
-        doc_url=req.doc_url,
-        controls_text=controls_text,
-        plan_id=req.plan_id,
-        stream=req.stream,
-    )
+    # Step 3: Generate the plan from the text we already fetched (always streamed)
+    plan = await call_llm_chat_streaming_async(build_doc_index(doc_text), controls_text, req.plan_id)
     return plan
 
 
 # ---- For local running ----
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+    )
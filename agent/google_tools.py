@@ -1,17 +1,24 @@
-import io
 import re
+import asyncio
+import threading
+import logging
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse, parse_qs
 from typing import Optional, Tuple
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
+from requests.adapters import HTTPAdapter
+import httpx
+import requests
 import os
 import json
 import uuid
 
+logger = logging.getLogger(__name__)
 
 class GoogleFetchError(Exception):
     pass
@@ -19,11 +26,14 @@ class GoogleFetchError(Exception):
 class GoogleDocCommentError(Exception):
     pass
 
+_DOC_ID_RE = re.compile(r"/d/([a-zA-Z0-9_-]{20,})")
+_FILE_ID_RE = re.compile(r"/file/d/([a-zA-Z0-9_-]{20,})")
+
 def _extract_id(url: str) -> Optional[str]:
-    m = re.search(r"/d/([a-zA-Z0-9_-]{20,})", url)
+    m = _DOC_ID_RE.search(url)
     if m:
         return m.group(1)
-    m = re.search(r"/file/d/([a-zA-Z0-9_-]{20,})", url)
+    m = _FILE_ID_RE.search(url)
     if m:
         return m.group(1)
     qs = parse_qs(urlparse(url).query)
@@ -32,8 +42,9 @@ def _extract_id(url: str) -> Optional[str]:
     return None
 
 def _detect_app(url: str) -> str:
-    host = urlparse(url).netloc
-    path = urlparse(url).path
+    parsed = urlparse(url)
+    host = parsed.netloc
+    path = parsed.path
     if "docs.google.com" in host:
         if path.startswith("/document/"):
             return "docs"
@@ -65,19 +76,142 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive",
 ]
 
-def _get_creds():
-    """One-time auth to create token.json; after that, loads from file."""
-    if os.path.exists("token.json"):
-        return Credentials.from_authorized_user_file("token.json", SCOPES)
+# Process-wide credentials and pooled HTTP clients, built once and reused.
+_CREDS: Optional[Credentials] = None
+_SESSION: Optional[AuthorizedSession] = None
+_ASYNC_CLIENT: Optional[httpx.AsyncClient] = None
+_LOCK = threading.Lock()
+
+TOKEN_PATH = "token.json"
+REFRESH_MARGIN = timedelta(minutes=5)
 
+def authorize_interactively() -> Credentials:
+    """One-time browser auth that creates token.json (run `python google_tools.py`)."""
     flow = InstalledAppFlow.from_client_secrets_file("client_secret.json", SCOPES)
     creds = flow.run_local_server(port=0)
-    with open("token.json", "w") as token:
-        token.write(creds.to_json())
+    _save_creds(creds)
     return creds
 
+def _save_creds(creds: Credentials) -> None:
+    """Write token.json atomically so a process loading it never sees a partial file."""
+    tmp = f"{TOKEN_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w") as token:
+        token.write(creds.to_json())
+    os.replace(tmp, TOKEN_PATH)
+
+def _load_creds() -> Credentials:
+    """Load the pre-provisioned token.json; never starts a browser flow."""
+    if not os.path.exists(TOKEN_PATH):
+        raise GoogleFetchError(
+            f"{TOKEN_PATH} not found; run `python google_tools.py` once to authorize."
+        )
+    return Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+
+def _get_creds() -> Credentials:
+    """Memoized credentials; refreshed only once they have expired."""
+    global _CREDS
+    with _LOCK:
+        if _CREDS is None:
+            _CREDS = _load_creds()
+        if _CREDS.expired and _CREDS.refresh_token:
+            _CREDS.refresh(Request())
+            _save_creds(_CREDS)
+        return _CREDS
+
+def refresh_creds(margin: timedelta = REFRESH_MARGIN) -> Credentials:
+    """
+    Refresh the shared credentials now and persist them to token.json.
+    Each uvicorn worker process runs its own refresher; if another worker has
+    already saved a token that is good beyond `margin`, adopt it instead of
+    refreshing again.
+    """
+    global _CREDS
+    with _LOCK:
+        if _CREDS is None:
+            _CREDS = _load_creds()
+        if not _CREDS.refresh_token:
+            return _CREDS
+        saved = _load_creds()
+        if saved.token != _CREDS.token and saved.expiry is not None and _seconds_until_refresh(saved, margin) > 0:
+            # update in place: AuthorizedSession holds this same Credentials object
+            _CREDS.token, _CREDS.expiry = saved.token, saved.expiry
+            return _CREDS
+        _CREDS.refresh(Request())
+        _save_creds(_CREDS)
+        return _CREDS
+
+def _seconds_until_refresh(creds: Credentials, margin: timedelta) -> float:
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (creds.expiry - margin - now).total_seconds()
+
+def creds_refresh_delay(margin: timedelta = REFRESH_MARGIN) -> float:
+    """Seconds until the shared token should be refreshed (`margin` before expiry)."""
+    creds = _get_creds()
+    if creds.expiry is None or not creds.refresh_token:
+        return 3600.0  # nothing to refresh on a schedule; check back hourly
+    return max(0.0, _seconds_until_refresh(creds, margin))
 
-
+def _get_session() -> AuthorizedSession:
+    """Pooled, auto-refreshing requests session for direct Drive REST calls."""
+    global _SESSION
+    creds = _get_creds()
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = AuthorizedSession(creds)
+            _SESSION.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=100, pool_block=False))
+        return _SESSION
+
+def _get_async_client() -> httpx.AsyncClient:
+    """Process-wide httpx.AsyncClient so the async path reuses keep-alive TLS connections."""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is None or _ASYNC_CLIENT.is_closed:
+        _ASYNC_CLIENT = httpx.AsyncClient(
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return _ASYNC_CLIENT
+
+async def aclose_http_clients() -> None:
+    """Close the shared async client (call on app shutdown)."""
+    global _ASYNC_CLIENT
+    if _ASYNC_CLIENT is not None:
+        await _ASYNC_CLIENT.aclose()
+        _ASYNC_CLIENT = None
+
+# Drive v3 REST endpoints, called directly (no discovery doc / generated stubs)
+_DRIVE_FILE = "https://www.googleapis.com/drive/v3/files/{id}"
+_DRIVE_EXPORT = "https://www.googleapis.com/drive/v3/files/{id}/export"
+_DRIVE_MEDIA = "https://www.googleapis.com/drive/v3/files/{id}?alt=media"
+_DOWNLOAD_CHUNK = 65536
+
+# Docs v1 REST endpoints, sent through the same pooled session
+_DOCS_DOCUMENT = "https://docs.googleapis.com/v1/documents/{id}"
+_DOCS_BATCH_UPDATE = "https://docs.googleapis.com/v1/documents/{id}:batchUpdate"
+
+# Fetched content keyed by (file_id, modifiedTime, app); an edit bumps modifiedTime.
+_DOC_CACHE: "OrderedDict[tuple, dict]" = OrderedDict()
+_DOC_CACHE_MAX = 64
+_DOC_CACHE_LOCK = threading.Lock()
+
+def _doc_cache_get(key: Optional[tuple]) -> Optional[dict]:
+    if key is None:
+        return None
+    with _DOC_CACHE_LOCK:
+        hit = _DOC_CACHE.get(key)
+        if hit is None:
+            return None
+        _DOC_CACHE.move_to_end(key)
+        return dict(hit)
+
+def _doc_cache_put(key: Optional[tuple], value: dict) -> None:
+    if key is None:
+        return
+    with _DOC_CACHE_LOCK:
+        _DOC_CACHE[key] = value
+        _DOC_CACHE.move_to_end(key)
+        while len(_DOC_CACHE) > _DOC_CACHE_MAX:
+            _DOC_CACHE.popitem(last=False)
 
 def fetch_google_url_private(url: str) -> dict:
     """
@@ -90,36 +224,49 @@ def fetch_google_url_private(url: str) -> dict:
         raise GoogleFetchError("Could not find a Google file ID in the URL.")
 
     app = _detect_app(url)
-    creds = _get_creds()
-    drive = build("drive", "v3", credentials=creds, cache_discovery=False)
-
+    session = _get_session()
+
+    # Cheap metadata call first: unchanged files are served from the cache
+    try:
+        meta = session.get(_DRIVE_FILE.format(id=file_id), params={"fields": "modifiedTime"}, timeout=60)
+        meta.raise_for_status()
+        modified = meta.json().get("modifiedTime")
+    except (requests.RequestException, ValueError):
+        modified = None  # let the real fetch below report access problems
+    key = (file_id, modified, app) if modified else None
+    cached = _doc_cache_get(key)
+    if cached is not None:
+        return cached
+    result = _fetch_drive(session, file_id, app)
+    _doc_cache_put(key, result)
+    return result
+
+def _fetch_drive(session: AuthorizedSession, file_id: str, app: str) -> dict:
     if app in ("docs", "sheets", "slides"):
         export_mime, logical = _choose_export_mime(app)
-        buf = io.BytesIO()
         try:
-            data = drive.files().export(fileId=file_id, mimeType=export_mime).execute()
-        except Exception as e:
+            resp = session.get(
+                _DRIVE_EXPORT.format(id=file_id),
+                params={"mimeType": export_mime},
+                timeout=60,
+            )
+            resp.raise_for_status()
+        except requests.RequestException as e:
             raise GoogleFetchError(f"Export failed (check access and API enablement): {e}") from e
-        buf.write(data)
-        content_bytes = buf.getvalue()
-        try:
-            text = content_bytes.decode("utf-8", errors="replace")
-        except Exception:
-            text = content_bytes.decode("utf-8", errors="replace")
+        text = resp.content.decode("utf-8", errors="replace")
         return {"content": text, "mime_type": export_mime, "source": "drive_export"}
 
     elif app in ("drive", "unknown"):
         # Generic Drive file: try raw download (binary) and best-effort decode.
-        request = drive.files().get_media(fileId=file_id)
-        buf = io.BytesIO()
-        downloader = MediaIoBaseDownload(buf, request)
-        done = False
+        buf = bytearray()
         try:
-            while not done:
-                status, done = downloader.next_chunk()
-        except Exception as e:
+            with session.get(_DRIVE_MEDIA.format(id=file_id), stream=True, timeout=60) as resp:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(_DOWNLOAD_CHUNK):
+                    buf += chunk
+        except requests.RequestException as e:
             raise GoogleFetchError(f"Download failed (check access and file type): {e}") from e
-        content = buf.getvalue()
+        content = buf
         # best-effort decode for text-like files
         try:
             text = content.decode("utf-8")
@@ -132,10 +279,116 @@ def fetch_google_url_private(url: str) -> dict:
     else:
         raise GoogleFetchError("Unrecognized Google URL type.")
 
-def _flatten_text(elems, acc, idx_map):
+# Ranged downloads: files up to the threshold come back in the first request,
+# anything larger is fetched as parallel 1 MiB range GETs.
+_RANGED_DOWNLOAD_THRESHOLD = 2 << 20
+_RANGE_CHUNK = 1 << 20
+_RANGE_CONCURRENCY = 8  # stay well under Drive's per-user rate limits
+
+def _content_range_total(resp: httpx.Response) -> Optional[int]:
+    """Total size from a `Content-Range: bytes a-b/total` header, if known."""
+    total = resp.headers.get("content-range", "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+async def _download_ranged(client: httpx.AsyncClient, url: str, headers: dict) -> bytes:
+    """GET a Drive media URL, splitting large files into concurrent range requests."""
+    first = await client.get(
+        url, headers={**headers, "Range": f"bytes=0-{_RANGED_DOWNLOAD_THRESHOLD - 1}"}
+    )
+    if first.status_code == 416:
+        return b""  # zero-byte file: no satisfiable range
+    first.raise_for_status()
+    total = _content_range_total(first)
+    if first.status_code != 206 or total is None or total <= len(first.content):
+        return first.content  # whole file already (small, or Range ignored)
+
+    sem = asyncio.Semaphore(_RANGE_CONCURRENCY)
+
+    async def _part(start: int, end: int) -> Optional[bytes]:
+        async with sem:
+            r = await client.get(url, headers={**headers, "Range": f"bytes={start}-{end}"})
+            r.raise_for_status()
+            if r.status_code != 206 or len(r.content) != end - start + 1:
+                return None  # range not honoured as asked; don't splice it in
+            return r.content
+
+    parts = await asyncio.gather(*(
+        _part(start, min(start + _RANGE_CHUNK, total) - 1)
+        for start in range(len(first.content), total, _RANGE_CHUNK)
+    ))
+    if any(part is None for part in parts):
+        # fall back to one plain GET rather than returning a corrupted file
+        resp = await client.get(url, headers=headers)
+        resp.raise_for_status()
+        return resp.content
+    return b"".join([first.content, *parts])
+
+async def fetch_google_url_private_async(url: str) -> dict:
     """
-    Walk Google Docs structural elements and build a flat string, while
-    mapping each character position -> document index (startIndex-based).
+    Async variant of fetch_google_url_private, talking to the Drive REST API
+    through the shared httpx.AsyncClient with the OAuth bearer token.
+    Same return shape and errors as the sync version.
+    """
+    file_id = _extract_id(url)
+    if not file_id:
+        raise GoogleFetchError("Could not find a Google file ID in the URL.")
+
+    app = _detect_app(url)
+    creds = _CREDS
+    if creds is None or not creds.valid:
+        # loading / refreshing is blocking; keep it off the event loop
+        creds = await asyncio.to_thread(_get_creds)
+    headers = {"Authorization": f"Bearer {creds.token}"}
+
+    client = _get_async_client()
+    try:
+        meta = await client.get(_DRIVE_FILE.format(id=file_id), params={"fields": "modifiedTime"}, headers=headers)
+        meta.raise_for_status()
+        modified = meta.json().get("modifiedTime")
+    except (httpx.HTTPError, ValueError):
+        modified = None  # let the real fetch below report access problems
+    key = (file_id, modified, app) if modified else None
+    cached = _doc_cache_get(key)
+    if cached is not None:
+        return cached
+    result = await _fetch_drive_async(client, headers, file_id, app)
+    _doc_cache_put(key, result)
+    return result
+
+async def _fetch_drive_async(client: httpx.AsyncClient, headers: dict, file_id: str, app: str) -> dict:
+    if app in ("docs", "sheets", "slides"):
+        export_mime, logical = _choose_export_mime(app)
+        try:
+            resp = await client.get(
+                _DRIVE_EXPORT.format(id=file_id),
+                params={"mimeType": export_mime},
+                headers=headers,
+            )
+            resp.raise_for_status()
+        except httpx.HTTPError as e:
+            raise GoogleFetchError(f"Export failed (check access and API enablement): {e}") from e
+        text = resp.content.decode("utf-8", errors="replace")
+        return {"content": text, "mime_type": export_mime, "source": "drive_export"}
+
+    elif app in ("drive", "unknown"):
+        try:
+            content = await _download_ranged(client, _DRIVE_MEDIA.format(id=file_id), headers)
+        except httpx.HTTPError as e:
+            raise GoogleFetchError(f"Download failed (check access and file type): {e}") from e
+        try:
+            text = content.decode("utf-8")
+            return {"content": text, "mime_type": "text/plain", "source": "drive_download"}
+        except UnicodeDecodeError:
+            return {"content": "", "mime_type": "application/octet-stream", "source": "drive_download"}
+
+    else:
+        raise GoogleFetchError("Unrecognized Google URL type.")
+
+def _flatten_text(elems, acc, runs):
+    """
+    Walk Google Docs structural elements and collect their text runs, while
+    recording one (char_offset, startIndex) pair per run so any character
+    position can be mapped back to a document index.
     """
     for el in elems:
         if "paragraph" in el:
@@ -144,32 +397,47 @@ def _flatten_text(elems, acc, idx_map):
                 end = ce.get("endIndex")
                 txt = ce.get("textRun", {}).get("content")
                 if txt and start is not None and end is not None:
-                    # Append and map indices
-                    base = len(acc["text"])
-                    acc["text"] += txt
-                    # Map every character to doc index (costly but simple & robust)
-                    for i, _ in enumerate(txt):
-                        idx_map[base + i] = start + i
+                    runs.append((acc["len"], start))
+                    acc["parts"].append(txt)
+                    acc["len"] += len(txt)
         elif "table" in el:
             for row in el["table"].get("tableRows", []):
                 for cell in row.get("tableCells", []):
-                    _flatten_text(cell.get("content", []), acc, idx_map)
+                    _flatten_text(cell.get("content", []), acc, runs)
         elif "sectionBreak" in el:
             # ignore
             pass
 
+def _doc_index_at(runs, pos: int) -> int:
+    """Map a flat-text character position to its document index."""
+    offset, start = runs[bisect_right(runs, (pos, float("inf"))) - 1]
+    return start + (pos - offset)
+
+# Partial-response mask for documents.get: only what _flatten_text reads
+# (paragraph text runs, including those inside table cells). A field mask can't
+# recurse, so tables nested deeper than _MAX_TABLE_NESTING come back empty.
+_PARAGRAPH_FIELDS = "paragraph(elements(startIndex,endIndex,textRun(content)))"
+_MAX_TABLE_NESTING = 4
+
+def _content_fields(depth: int) -> str:
+    if depth == 0:
+        return _PARAGRAPH_FIELDS
+    return f"{_PARAGRAPH_FIELDS},table(tableRows(tableCells(content({_content_fields(depth - 1)}))))"
+
+_SEGMENT_LOOKUP_FIELDS = f"body(content({_content_fields(_MAX_TABLE_NESTING)}))"
+
 def _find_segment_indices(doc, segment: str) -> Tuple[int, int]:
     body = doc.get("body", {})
     content = body.get("content", [])
-    acc = {"text": ""}
-    idx_map = {}
-    _flatten_text(content, acc, idx_map)
-    hay = acc["text"]
+    acc = {"parts": [], "len": 0}
+    runs = []
+    _flatten_text(content, acc, runs)
+    hay = "".join(acc["parts"])
     pos = hay.find(segment)
     if pos == -1:
         raise GoogleDocCommentError("Segment text not found in document.")
-    start_doc_index = idx_map[pos]
-    end_doc_index = idx_map[pos + len(segment) - 1] + 1
+    start_doc_index = _doc_index_at(runs, pos)
+    end_doc_index = _doc_index_at(runs, pos + len(segment) - 1) + 1
     return start_doc_index, end_doc_index
 
 def patch_with_strikethrough_and_color(docs, file_id, start_idx, end_idx, new_text):
@@ -225,12 +493,15 @@ def add_comment_to_segment(doc_url: str, segment_text: str, replacement_text: st
     and inserts `replacement_text` right after it with green background (no strikethrough).
     """
     file_id = _extract_id(doc_url)
-    creds = _get_creds()
-
-    docs = build("docs", "v1", credentials=creds, cache_discovery=False)
-
-    # 1) Fetch doc structure and locate the segment
-    doc = docs.documents().get(documentId=file_id).execute()
+    session = _get_session()
+
+    # 1) Fetch just the text runs (and their indices) needed to locate the segment
+    try:
+        resp = session.get(_DOCS_DOCUMENT.format(id=file_id), params={"fields": _SEGMENT_LOOKUP_FIELDS}, timeout=60)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        raise GoogleDocCommentError(f"Could not read document: {e}") from e
+    doc = resp.json()
     start_idx, end_idx = _find_segment_indices(doc, segment_text)
 
     # Colors: soft red/green so the text stays readable
@@ -241,7 +512,7 @@ def add_comment_to_segment(doc_url: str, segment_text: str, replacement_text: st
     sep = " "
     inserted = sep + replacement_text
 
-    requests = [
+    updates = [
         # A) Style the OLD text (Text 1): strikethrough + red background
         {
             "updateTextStyle": {
@@ -276,7 +547,11 @@ def add_comment_to_segment(doc_url: str, segment_text: str, replacement_text: st
         }
     ]
 
-    docs.documents().batchUpdate(documentId=file_id, body={"requests": requests}).execute()
+    try:
+        resp = session.post(_DOCS_BATCH_UPDATE.format(id=file_id), json={"requests": updates}, timeout=60)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        raise GoogleDocCommentError(f"batchUpdate failed: {e}") from e
 
     payload = {
         "file_id": file_id,
@@ -287,13 +562,15 @@ def add_comment_to_segment(doc_url: str, segment_text: str, replacement_text: st
         "new_text_start": end_idx + len(sep),
         "new_text_end": end_idx + len(sep) + len(replacement_text),
     }
-    print(payload)
+    logger.debug("patched segment: %s", payload)
     return payload
 
 # print(result["content"][:8000])
 
 if __name__ == "__main__":
-    # Example usage (set GOOGLE_CLIENT_SECRET_FILE or GOOGLE_CLIENT_SECRET_JSON and GOOGLE_TOKEN_PATH first):
+    # One-time setup: needs client_secret.json, writes token.json for the server/CLI.
+    authorize_interactively()
+    print(f"Wrote {TOKEN_PATH}")
+    # Example usage:
     # url = "https://docs.google.com/document/d/.../edit"
     # print(fetch_google_url_private(url))
-    pass
\ No newline at end of file
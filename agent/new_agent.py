@@ -31,17 +31,23 @@ from __future__ import annotations
 
 import os
 import re
-import json
+import ijson
+import orjson
 import argparse
-from typing import List, Optional, Tuple, Literal
+import logging
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Tuple, Literal
 
-from pydantic import BaseModel, ValidationError
-from openai import OpenAI
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from openai import AsyncOpenAI, OpenAI
 
 # Your existing tools (must be on PYTHONPATH)
 from google_tools import fetch_google_url_private
 
 
+logger = logging.getLogger(__name__)
+
+
 # =========================
 # Pydantic data contract
 # =========================
@@ -66,6 +72,36 @@ class PlanV1(BaseModel):
     preamble: Optional[Preamble] = None
     patches: List[Patch]
 
+_PATCHES_ADAPTER = TypeAdapter(List[Patch])
+
+def salvage_patches(items) -> List[Patch]:
+    """Validate a raw patch list in one call, dropping only the entries that fail."""
+    if not isinstance(items, list):
+        return []
+    try:
+        return _PATCHES_ADAPTER.validate_python(items)
+    except ValidationError as e:
+        bad = {err["loc"][0] for err in e.errors() if err["loc"]}
+        return _PATCHES_ADAPTER.validate_python([p for i, p in enumerate(items) if i not in bad])
+
+def _valid_preamble(raw) -> Optional[Preamble]:
+    if not raw:
+        return None
+    try:
+        return Preamble.model_validate(raw)
+    except ValidationError:
+        return None
+
+def salvage_plan(data: dict, plan_id: str) -> PlanV1:
+    """Envelope failed validation: keep the preamble and patches that are valid on their own."""
+    raw_id = data.get("plan_id")
+    return PlanV1(
+        schema_version="1.0",
+        plan_id=raw_id if isinstance(raw_id, str) else plan_id,
+        preamble=_valid_preamble(data.get("preamble")),
+        patches=salvage_patches(data.get("patches")),
+    )
+
 
 # =========================
 # Prompt & schema
@@ -86,9 +122,10 @@ Controls (may be empty; use to bias suggestions):
 {controls}
 
 Contract text (truncated for context):
-{doc_snippet}
 """
 
+SNIPPET_MAX_CHARS = 18000  # keep it sane
+
 # Strict JSON schema for Structured Outputs
 PLAN_SCHEMA = {
     "type": "object",
@@ -133,8 +170,7 @@ PLAN_SCHEMA = {
 
 Heading = Tuple[str, int, int]  # (heading_line, start_idx, end_idx) in lines[]
 
-def extract_headings_and_ranges(doc_text: str) -> List[Heading]:
-    lines = doc_text.splitlines()
+def extract_headings_and_ranges(lines: List[str]) -> List[Heading]:
     heads = [i for i, ln in enumerate(lines) if ln.strip().startswith("## ")]
     out: List[Heading] = []
     for idx, h_i in enumerate(heads):
@@ -143,32 +179,33 @@ def extract_headings_and_ranges(doc_text: str) -> List[Heading]:
         out.append((heading_line, h_i, end_i))
     return out
 
-def section_range_for(heading_line: str, headings: List[Heading]) -> Optional[Tuple[int, int]]:
-    for h, start, end in headings:
-        if h.strip() == heading_line.strip():
-            return (start, end)
-    return None
+@dataclass
+class DocIndex:
+    """Everything derived from the doc text, computed once per request."""
+    text: str
+    lines: List[str]
+    headings: List[Heading]
+    sections: Dict[str, FrozenSet[str]]  # stripped heading -> stripped, non-blank lines
 
-def line_exists_in_section(orig_line: str, section_range: Tuple[int, int], doc_text: str) -> bool:
-    start, end = section_range
+def build_doc_index(doc_text: str) -> DocIndex:
     lines = doc_text.splitlines()
-    needle = orig_line.strip()
-    for i in range(start + 1, end):
-        if lines[i].strip() == needle:
-            return True
-    return False
-
-def lint_plan_against_doc(plan: PlanV1, doc_text: str) -> PlanV1:
+    headings = extract_headings_and_ranges(lines)
+    sections: Dict[str, FrozenSet[str]] = {}
+    for h, start, end in headings:
+        key = h.strip()
+        if key in sections:
+            continue  # first occurrence of a heading wins
+        sections[key] = frozenset(s for s in (ln.strip() for ln in lines[start + 1:end]) if s)
+    return DocIndex(text=doc_text, lines=lines, headings=headings, sections=sections)
+
+def patch_in_doc(p: Patch, doc_index: DocIndex) -> bool:
+    """True if p.section is a heading of the doc and p.orig_text a line under it."""
+    lines = doc_index.sections.get(p.section.strip())
+    return bool(lines) and p.orig_text.strip() in lines
+
+def lint_plan_against_doc(plan: PlanV1, doc_index: DocIndex) -> PlanV1:
     """Drop patches whose section or orig_text cannot be verified."""
-    headings = extract_headings_and_ranges(doc_text)
-    keep: List[Patch] = []
-    for p in plan.patches:
-        rng = section_range_for(p.section, headings)
-        if not rng:
-            continue
-        if not line_exists_in_section(p.orig_text, rng, doc_text):
-            continue
-        keep.append(p)
+    keep = [p for p in plan.patches if patch_in_doc(p, doc_index)]
     return PlanV1(schema_version="1.0", plan_id=plan.plan_id, preamble=plan.preamble, patches=keep)
 
 
@@ -176,18 +213,28 @@ def lint_plan_against_doc(plan: PlanV1, doc_text: str) -> PlanV1:
 # LLM calls (stream / non-stream)
 # =========================
 
-def build_user_message(doc_text: str, controls_text: Optional[str]) -> str:
-    headings = extract_headings_and_ranges(doc_text)
-    head_block = "\n".join(h for (h, _, _) in headings) or "(no headings found)"
+def doc_snippet(doc_text: str, limit: int = SNIPPET_MAX_CHARS) -> str:
+    """Return doc_text as-is if short enough, else cut at the last newline before `limit`."""
+    if len(doc_text) <= limit:
+        return doc_text
+    cut = doc_text.rfind("\n", 0, limit)
+    return doc_text[:cut if cut > 0 else limit]
+
+def build_user_message(doc_index: DocIndex, controls_text: Optional[str]) -> List[dict]:
+    """User message content parts; the (large) doc snippet is its own part, never copied into the template."""
+    head_block = "\n".join(h for (h, _, _) in doc_index.headings) or "(no headings found)"
     controls_block = (controls_text or "").strip() or "(none provided)"
-    snippet = doc_text[:18000]  # keep it sane
-    return USER_TMPL.format(headings=head_block, controls=controls_block, doc_snippet=snippet)
+    return [
+        {"type": "text", "text": USER_TMPL.format(headings=head_block, controls=controls_block)},
+        {"type": "text", "text": doc_snippet(doc_index.text)},
+    ]
 
 def call_llm_structured(doc_text: str, controls_text: Optional[str], plan_id: str, stream: bool = True) -> PlanV1:
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     model = os.getenv("OPENAI_MODEL", "gpt-5")
 
-    user_msg = build_user_message(doc_text, controls_text)
+    doc_index = build_doc_index(doc_text)
+    user_msg = "".join(part["text"] for part in build_user_message(doc_index, controls_text))
     messages = [
         {"role": "system", "content": SYS_PROMPT},
         {"role": "user", "content": user_msg},
@@ -195,27 +242,26 @@ def call_llm_structured(doc_text: str, controls_text: Optional[str], plan_id: st
 
     def _parse_to_plan(text: str) -> PlanV1:
         try:
-            data = json.loads(text)
+            # fast path: parse + validate straight from the JSON text in pydantic-core
+            return lint_plan_against_doc(PlanV1.model_validate_json(text), doc_index)
+        except ValidationError:
+            pass
+        try:
+            data = orjson.loads(text)
         except Exception:
             # salvage JSON substring
             start, end = text.find("{"), text.rfind("}")
             if start != -1 and end != -1 and end >= start:
-                data = json.loads(text[start:end+1])
+                data = orjson.loads(text[start:end+1])
             else:
                 data = {"schema_version": "1.0", "plan_id": plan_id, "patches": []}
         data.setdefault("plan_id", plan_id)
         try:
             plan = PlanV1(**data)
         except ValidationError:
-            # salvage valid patches if envelope is off
-            good = []
-            for p in data.get("patches", []) or []:
-                try:
-                    good.append(Patch(**p))
-                except ValidationError:
-                    pass
-            plan = PlanV1(schema_version="1.0", plan_id=data.get("plan_id", plan_id), patches=good)
-        return lint_plan_against_doc(plan, doc_text)
+            # salvage valid parts if envelope is off
+            plan = salvage_plan(data, plan_id)
+        return lint_plan_against_doc(plan, doc_index)
 
     # Prefer Responses API if available
     has_responses = hasattr(client, "responses") and hasattr(client.responses, "create")
@@ -232,15 +278,13 @@ def call_llm_structured(doc_text: str, controls_text: Optional[str], plan_id: st
                 stream=True,
             )
             buf = []
-            print("\n--- streaming model output (structured JSON via Responses) ---\n", flush=True)
             for event in events:
                 if event.type == "response.output_text.delta":
-                    print(event.delta, end="", flush=True)
                     buf.append(event.delta)
                 elif event.type == "response.error":
                     raise RuntimeError(getattr(event, "error", "model stream error"))
-            print("\n\n--- end stream ---\n", flush=True)
             text = "".join(buf)
+            logger.debug("model output (responses stream):\n%s", text)
             return _parse_to_plan(text)
         else:
             final = client.responses.create(
@@ -271,17 +315,16 @@ def call_llm_structured(doc_text: str, controls_text: Optional[str], plan_id: st
             stream_obj = client.chat.completions.create(**kwargs)
 
         buf = []
-        print("\n--- streaming model output (chat.completions) ---\n", flush=True)
         for chunk in stream_obj:
             try:
                 delta = chunk.choices[0].delta
                 if delta and getattr(delta, "content", None):
-                    print(delta.content, end="", flush=True)
                     buf.append(delta.content)
             except Exception:
                 pass
-        print("\n\n--- end stream ---\n", flush=True)
-        return _parse_to_plan("".join(buf))
+        text = "".join(buf)
+        logger.debug("model output (chat.completions stream):\n%s", text)
+        return _parse_to_plan(text)
 
     # Fallback: Chat Completions (non-stream)
     try:
@@ -308,16 +351,120 @@ def call_llm_structured(doc_text: str, controls_text: Optional[str], plan_id: st
 #     doc_text = doc.get("content", "")
 #     return call_llm_structured(doc_text, controls_text, plan_id, stream=stream)
 
-from openai import OpenAI
-import json, os
-from typing import Optional, List
-from pydantic import ValidationError
+class PatchStream:
+    """
+    Incrementally parses streamed model output and validates + lints each
+    `patches[*]` object as soon as it is complete, so that work overlaps
+    with generation instead of waiting for the whole response. `plan_id`
+    and `preamble` are captured from the same parse, so a clean stream is
+    never parsed twice.
+    `ok` turns False if the output isn't clean JSON; callers then fall back
+    to parsing the full buffer.
+    """
+
+    _CAPTURED = ("patches.item", "preamble", "plan_id")
+
+    def __init__(self, doc_index: DocIndex):
+        self.doc_index = doc_index
+        self.accepted: List[Patch] = []
+        self.plan_id = None
+        self.preamble = None
+        self.ok = True
+        self._events = ijson.sendable_list()
+        self._coro = ijson.parse_coro(self._events)
+        self._builder: Optional[ijson.ObjectBuilder] = None
+        self._building = ""
+        self._depth = 0
+
+    def feed(self, chunk: str) -> None:
+        if not self.ok:
+            return
+        try:
+            self._coro.send(chunk.encode("utf-8"))
+        except ijson.JSONError:
+            self.ok = False
+            return
+        self._drain()
+
+    def close(self) -> None:
+        if not self.ok:
+            return
+        try:
+            self._coro.close()
+        except ijson.JSONError:
+            self.ok = False
+            return
+        self._drain()
+
+    def plan(self, plan_id: str) -> PlanV1:
+        """The linted plan; same envelope rules as salvage_plan."""
+        return PlanV1(
+            schema_version="1.0",
+            plan_id=self.plan_id if isinstance(self.plan_id, str) else plan_id,
+            preamble=_valid_preamble(self.preamble),
+            patches=self.accepted,
+        )
+
+    def _drain(self) -> None:
+        for prefix, event, value in self._events:
+            if self._builder is not None:
+                # inside a captured object/array: build until it closes
+                self._builder.event(event, value)
+                if event in ("start_map", "start_array"):
+                    self._depth += 1
+                elif event in ("end_map", "end_array"):
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._capture(self._building, self._builder.value)
+                        self._builder = None
+            elif prefix in self._CAPTURED:
+                if event in ("start_map", "start_array"):
+                    self._builder = ijson.ObjectBuilder()
+                    self._builder.event(event, value)
+                    self._building, self._depth = prefix, 1
+                elif event != "map_key":
+                    self._capture(prefix, value)
+        del self._events[:]
+
+    def _capture(self, prefix: str, value) -> None:
+        if prefix == "plan_id":
+            self.plan_id = value
+        elif prefix == "preamble":
+            self.preamble = value
+        else:
+            try:
+                p = Patch(**value)
+            except (TypeError, ValidationError):
+                return
+            if patch_in_doc(p, self.doc_index):
+                self.accepted.append(p)
+
+
+def _parse_plan(text: str, plan_id: str, doc_index: DocIndex) -> PlanV1:
+    """
+    Parse → Pydantic → lint for the chat-streaming paths. Only reached when
+    PatchStream rejected the output as JSON, so go straight to salvaging.
+    """
+    try:
+        data = orjson.loads(text)
+    except Exception:
+        start, end = text.find("{"), text.rfind("}")
+        if start != -1 and end != -1 and end >= start:
+            data = orjson.loads(text[start:end+1])
+        else:
+            data = {"schema_version": "1.0", "plan_id": plan_id, "patches": []}
+    data.setdefault("plan_id", plan_id)
+    try:
+        plan = PlanV1(**data)
+    except ValidationError:
+        plan = salvage_plan(data, plan_id)
+    return lint_plan_against_doc(plan, doc_index)
 
-def call_llm_chat_streaming(doc_text: str, controls_text: Optional[str], plan_id: str) -> PlanV1:
+def call_llm_chat_streaming(doc_index: DocIndex, controls_text: Optional[str], plan_id: str) -> PlanV1:
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     model = os.getenv("OPENAI_MODEL", "gpt-5")
 
-    user_msg = build_user_message(doc_text, controls_text)
+    user_msg = build_user_message(doc_index, controls_text)
     messages = [
         {"role": "system", "content": SYS_PROMPT},
         {"role": "user", "content": user_msg},
@@ -325,23 +472,25 @@ def call_llm_chat_streaming(doc_text: str, controls_text: Optional[str], plan_id
 
     # Try: schema-constrained streaming -> json_schema, then json_object, then no constraint
     def _stream_with_kwargs(**kwargs):
-        print("\n--- streaming (chat.completions) ---\n", flush=True)
         buf: List[str] = []
+        patches = PatchStream(doc_index)
         stream = client.chat.completions.create(stream=True, **kwargs)
         for chunk in stream:
             try:
                 delta = chunk.choices[0].delta
                 if delta and getattr(delta, "content", None):
-                    print(delta.content, end="", flush=True)
                     buf.append(delta.content)
+                    patches.feed(delta.content)
             except Exception:
                 pass
-        print("\n\n--- end stream ---\n", flush=True)
-        return "".join(buf)
+        patches.close()
+        text = "".join(buf)
+        logger.debug("model output (chat.completions stream):\n%s", text)
+        return text, patches
 
     try:
         # Newer SDKs may support json_schema on chat
-        text = _stream_with_kwargs(
+        text, patches = _stream_with_kwargs(
             model=model,
             messages=messages,
             response_format={
@@ -353,7 +502,7 @@ def call_llm_chat_streaming(doc_text: str, controls_text: Optional[str], plan_id
     except TypeError:
         try:
             # Widely supported: json_object
-            text = _stream_with_kwargs(
+            text, patches = _stream_with_kwargs(
                 model=model,
                 messages=messages,
                 response_format={"type": "json_object"},
@@ -361,43 +510,86 @@ def call_llm_chat_streaming(doc_text: str, controls_text: Optional[str], plan_id
             )
         except TypeError:
             # Oldest fallback: no response_format; rely on prompt
-            text = _stream_with_kwargs(
+            text, patches = _stream_with_kwargs(
                 model=model,
                 messages=messages,
                 #temperature=0.2,
             )
 
-    # Parse → Pydantic → lint
-    def _parse(text: str) -> PlanV1:
-        try:
-            data = json.loads(text)
-        except Exception:
-            start, end = text.find("{"), text.rfind("}")
-            if start != -1 and end != -1 and end >= start:
-                data = json.loads(text[start:end+1])
-            else:
-                data = {"schema_version": "1.0", "plan_id": plan_id, "patches": []}
-        data.setdefault("plan_id", plan_id)
+    return patches.plan(plan_id) if patches.ok else _parse_plan(text, plan_id, doc_index)
+
+
+_ASYNC_OPENAI: Optional[AsyncOpenAI] = None
+
+def _get_async_openai() -> AsyncOpenAI:
+    """Process-wide AsyncOpenAI so every request reuses one connection pool to the API."""
+    global _ASYNC_OPENAI
+    if _ASYNC_OPENAI is None or _ASYNC_OPENAI.is_closed():
+        _ASYNC_OPENAI = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _ASYNC_OPENAI
+
+async def aclose_llm_client() -> None:
+    """Close the shared AsyncOpenAI client (call on app shutdown)."""
+    global _ASYNC_OPENAI
+    if _ASYNC_OPENAI is not None:
+        await _ASYNC_OPENAI.close()
+        _ASYNC_OPENAI = None
+
+async def call_llm_chat_streaming_async(doc_index: DocIndex, controls_text: Optional[str], plan_id: str) -> PlanV1:
+    """Async twin of call_llm_chat_streaming for the FastAPI endpoint (AsyncOpenAI)."""
+    client = _get_async_openai()
+    model = os.getenv("OPENAI_MODEL", "gpt-5")
+
+    user_msg = build_user_message(doc_index, controls_text)
+    messages = [
+        {"role": "system", "content": SYS_PROMPT},
+        {"role": "user", "content": user_msg},
+    ]
+
+    async def _stream_with_kwargs(**kwargs):
+        buf: List[str] = []
+        patches = PatchStream(doc_index)
+        stream = await client.chat.completions.create(stream=True, **kwargs)
+        async for chunk in stream:
+            try:
+                delta = chunk.choices[0].delta
+                if delta and getattr(delta, "content", None):
+                    buf.append(delta.content)
+                    patches.feed(delta.content)
+            except Exception:
+                pass
+        patches.close()
+        text = "".join(buf)
+        logger.debug("model output (chat.completions stream):\n%s", text)
+        return text, patches
+
+    try:
+        text, patches = await _stream_with_kwargs(
+            model=model,
+            messages=messages,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "PlanV1", "schema": {**PLAN_SCHEMA, "strict": True}},
+            },
+        )
+    except TypeError:
         try:
-            plan = PlanV1(**data)
-        except ValidationError:
-            good = []
-            for p in data.get("patches", []) or []:
-                try:
-                    good.append(Patch(**p))
-                except ValidationError:
-                    pass
-            plan = PlanV1(schema_version="1.0", plan_id=data.get("plan_id", plan_id), patches=good)
-        return lint_plan_against_doc(plan, doc_text)
+            text, patches = await _stream_with_kwargs(
+                model=model,
+                messages=messages,
+                response_format={"type": "json_object"},
+            )
+        except TypeError:
+            text, patches = await _stream_with_kwargs(model=model, messages=messages)
 
-    return _parse(text)
+    return patches.plan(plan_id) if patches.ok else _parse_plan(text, plan_id, doc_index)
 
 
 def generate_plan_from_doc_url(doc_url: str, controls_text: Optional[str] = None, plan_id: str = "plan_generated_001", stream: bool = True) -> PlanV1:
     doc = fetch_google_url_private(doc_url)
-    doc_text = doc.get("content", "")
+    doc_index = build_doc_index(doc.get("content", ""))
     # Force streaming via Chat Completions
-    return call_llm_chat_streaming(doc_text, controls_text, plan_id)
+    return call_llm_chat_streaming(doc_index, controls_text, plan_id)
 
 
 # =========================
@@ -412,6 +604,7 @@ def main():
     ap.add_argument("--plan-id", default="plan_generated_001", help="Plan id to stamp")
     ap.add_argument("--no-stream", action="store_true", help="Disable streaming (use non-streaming call)")
     args = ap.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 
     controls_text = None
     if args.controls:
@@ -427,11 +620,11 @@ def main():
 
     payload = plan.model_dump() if hasattr(plan, "model_dump") else plan.__dict__
     if args.out:
-        with open(args.out, "w", encoding="utf-8") as f:
-            json.dump(payload, f, ensure_ascii=False, indent=2)
+        with open(args.out, "wb") as f:
+            f.write(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
         print(f"\nWrote {args.out}")
     else:
-        print(json.dumps(payload, ensure_ascii=False, indent=2))
+        print(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
 
 if __name__ == "__main__":
     main()